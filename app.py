@@ -1,11 +1,16 @@
 import streamlit as st
 import duckdb
 from lxml import etree
-import tempfile
-import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import os
+import sys
 import hashlib
+import time
 from pathlib import Path
 
 # Configuração da página
@@ -15,61 +20,300 @@ st.set_page_config(
     layout="wide",
 )
 
-# Tags ICMS para busca
-icms_tags = ["ICMS00", "ICMS20"]
+# Namespace para XML de notas fiscais
+NSMAP = {"ns": "http://www.portalfiscal.inf.br/nfcom"}
+NS = "{http://www.portalfiscal.inf.br/nfcom}"
+
+# Tags qualificadas (notação de Clark) usadas sem resolução de prefixo
+NS_IDE = NS + "ide"
+NS_NNF = NS + "nNF"
+NS_DHEMI = NS + "dhEmi"
+NS_TOTAL = NS + "total"
+NS_VNF = NS + "vNF"
+NS_DET = NS + "det"
+NS_CFOP = NS + "CFOP"
+NS_CCLASS = NS + "cClass"
+NS_VPROD = NS + "vProd"
+NS_VBC = NS + "vBC"
+NS_VDESC = NS + "vDesc"
+NS_VOUTRO = NS + "vOutro"
+NS_IND_DEVOLUCAO = NS + "indDevolucao"
+NS_IND_SEM_CST = NS + "indSemCST"
+
+# Expressões XPath compiladas uma única vez para o laço de itens
+XP_PROD = etree.XPath("ns:prod", namespaces=NSMAP)
+XP_IMPOSTO = etree.XPath("ns:imposto", namespaces=NSMAP)
+XP_PIS_CST = etree.XPath("ns:PIS/ns:CST", namespaces=NSMAP)
+XP_COFINS_CST = etree.XPath("ns:COFINS/ns:CST", namespaces=NSMAP)
+XP_PIS_VBC = etree.XPath("ns:PIS/ns:vBC", namespaces=NSMAP)
+XP_COFINS_VBC = etree.XPath("ns:COFINS/ns:vBC", namespaces=NSMAP)
+XP_VICMS = etree.XPath(".//ns:ICMS00/ns:vICMS|.//ns:ICMS20/ns:vICMS", namespaces=NSMAP)
+
+# Código ICMS a partir da tag (qualificada) que contém o vICMS
+ICMS_CODE_MAP = {NS + "ICMS" + c: sys.intern(c) for c in ("00", "20")}
+
+# Schema Arrow dos lotes inseridos em itens_completos (dhEmi e
+# indicador_devolucao chegam como texto e são convertidos pelo DuckDB;
+# colunas float64 são extraídas como texto e convertidas no envio do lote)
+ITENS_SCHEMA = pa.schema(
+    [
+        ("filename", pa.string()),
+        ("codigo_filial", pa.string()),
+        ("nNF", pa.int32()),
+        ("dhEmi", pa.string()),
+        ("nItem", pa.string()),
+        ("CFOP", pa.string()),
+        ("cClass", pa.string()),
+        ("vProd", pa.float64()),
+        ("vBC", pa.float64()),
+        ("vDesc", pa.float64()),
+        ("vOutro", pa.float64()),
+        ("vNF", pa.float64()),
+        ("pis_cst", pa.string()),
+        ("cofins_cst", pa.string()),
+        ("pis_vbc", pa.float64()),
+        ("cofins_vbc", pa.float64()),
+        ("vicms", pa.float64()),
+        ("ICMS_CODE", pa.string()),
+        ("indicador_devolucao", pa.string()),
+        ("ind_sem_cst", pa.string()),
+    ]
+)
+
+# Quantidade de registros por lote de inserção
+BATCH_SIZE = 50000
+
+# Arquivos em andamento por thread de parse (enviados ao pool e ainda não
+# inseridos no lote)
+PARSE_AHEAD = 2
+
+# Intervalo mínimo (segundos) entre atualizações da barra de progresso
+PROGRESS_INTERVAL = 0.05
 
 # Diretório para armazenar bancos de dados
 DB_DIR = Path("./databases")
 DB_DIR.mkdir(exist_ok=True)
 
-
-def safe_float(value):
-    """Converte valor para float de forma segura"""
+# Limites do cache de bancos abertos: quantidade máxima de sessões e tempo
+# (segundos) sem uso até o banco ser descartado do cache
+DB_CACHE_MAX_ENTRIES = 8
+DB_CACHE_TTL = 30 * 60
+
+
+def first_match(xpath, elem):
+    """Retorna o primeiro elemento encontrado pela expressão XPath ou None"""
+    result = xpath(elem)
+    return result[0] if result else None
+
+
+def iter_faturas(source, state):
+    """Percorre as faturas do XML incrementalmente, liberando cada uma após o uso.
+
+    O primeiro sirius/codigo_filial do arquivo é guardado em state["codigo_filial"].
+    """
+    for _, elem in etree.iterparse(
+        source, events=("end",), tag=("Fatura", "codigo_filial")
+    ):
+        if elem.tag == "codigo_filial":
+            # Primeiro código de filial do arquivo (sirius/codigo_filial)
+            if state["codigo_filial"] is None and elem.getparent().tag == "sirius":
+                state["codigo_filial"] = elem.text
+            continue
+
+        yield elem
+
+        # Descarta a fatura já processada e os irmãos anteriores
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def insert_batch(con, cols, fingerprints, total_rows):
+    """Insere o lote via Arrow, registra os arquivos concluídos e esvazia o lote"""
+    arrays = []
+    for field in ITENS_SCHEMA:
+        values = cols[field.name]
+        if pa.types.is_floating(field.type):
+            # Conversão vetorizada para float; valores inválidos viram nulos
+            values = pd.to_numeric(values, errors="coerce")
+            arrays.append(pa.array(values, type=field.type, from_pandas=True))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+
+    table = pa.Table.from_arrays(arrays, schema=ITENS_SCHEMA)
+    con.begin()
     try:
-        return float(value) if value else None
+        con.from_arrow(table).insert_into("itens_completos")
+        con.executemany(
+            "INSERT INTO parsed_files VALUES (?)",
+            [[h] for h in fingerprints],
+        )
+        # Total de registros mantido em _meta para leitura sem COUNT(*)
+        con.execute(
+            "INSERT OR REPLACE INTO _meta VALUES ('rows', ?)", [str(total_rows)]
+        )
+        con.commit()
     except Exception:
-        return None
+        con.rollback()
+        raise
+    fingerprints.clear()
+    for values in cols.values():
+        values.clear()
+
+
+def parse_xml_file(data, file_name):
+    """Extrai os itens de um arquivo XML em formato colunar (uma lista por coluna)"""
+    cols = {name: [] for name in ITENS_SCHEMA.names}
+    state = {"codigo_filial": None}
+
+    # Procura por cada nota fiscal (parse incremental do XML)
+    for fatura in iter_faturas(BytesIO(data), state):
+        # Extrai dados fiscais da nota (ide)
+        nf_com_vivo = fatura.find("NFComVivo")
+        ide = next(nf_com_vivo.iter(NS_IDE), None)
+        if ide is None:
+            continue
+
+        nNF_elem = ide.find(NS_NNF)
+        dhEmi_elem = ide.find(NS_DHEMI)
+
+        if nNF_elem is None or dhEmi_elem is None:
+            continue
+
+        try:
+            nNF = int(nNF_elem.text)
+            dhEmi = dhEmi_elem.text
+        except Exception:
+            continue
+
+        total_info = next(fatura.iter(NS_TOTAL), None)
+        vNF = total_info.findtext(NS_VNF) if total_info is not None else None
+
+        # Para cada item <det> dentro dessa nota
+        for det in fatura.iter(NS_DET):
+            nItem = det.get("nItem")
+            prod = first_match(XP_PROD, det)
+            if prod is None:
+                continue
+
+            cfop = prod.findtext(NS_CFOP, default="0000")
+            cClass_text = prod.findtext(NS_CCLASS)
+            cClass = sys.intern(cClass_text[:3]) if cClass_text else None
+
+            vProd = prod.findtext(NS_VPROD)
+            vBC = prod.findtext(NS_VBC)
+            vDesc = prod.findtext(NS_VDESC)
+            vOutro = prod.findtext(NS_VOUTRO)
+
+            tag_imposto = first_match(XP_IMPOSTO, det)
+            if tag_imposto is None:
+                continue
+
+            indicador_devolucao = tag_imposto.findtext(NS_IND_DEVOLUCAO, default="0")
+            ind_sem_cst = tag_imposto.findtext(NS_IND_SEM_CST, default="-")
+
+            pis_cst = first_match(XP_PIS_CST, tag_imposto)
+            cofins_cst = first_match(XP_COFINS_CST, tag_imposto)
+
+            pis_vbc = first_match(XP_PIS_VBC, tag_imposto)
+            cofins_vbc = first_match(XP_COFINS_VBC, tag_imposto)
+
+            vicms = "0"
+            ICMS_CODE = "-"
+            vICMS_element = first_match(XP_VICMS, tag_imposto)
+            if vICMS_element is not None:
+                vicms = vICMS_element.text
+                ICMS_CODE = ICMS_CODE_MAP[vICMS_element.getparent().tag]
+
+            cols["filename"].append(file_name)
+            cols["nNF"].append(nNF)
+            cols["dhEmi"].append(dhEmi)
+            cols["nItem"].append(nItem)
+            cols["CFOP"].append(cfop)
+            cols["cClass"].append(cClass)
+            cols["vProd"].append(vProd)
+            cols["vBC"].append(vBC)
+            cols["vDesc"].append(vDesc)
+            cols["vOutro"].append(vOutro)
+            cols["vNF"].append(vNF)
+            cols["pis_cst"].append(pis_cst.text if pis_cst is not None else None)
+            cols["cofins_cst"].append(
+                cofins_cst.text if cofins_cst is not None else None
+            )
+            cols["pis_vbc"].append(pis_vbc.text if pis_vbc is not None else None)
+            cols["cofins_vbc"].append(
+                cofins_vbc.text if cofins_vbc is not None else None
+            )
+            cols["vicms"].append(vicms)
+            cols["ICMS_CODE"].append(ICMS_CODE)
+            cols["indicador_devolucao"].append(indicador_devolucao)
+            cols["ind_sem_cst"].append(ind_sem_cst)
+
+    # Filial é a primeira do arquivo inteiro, mesmo que o sirius venha
+    # depois das faturas; só é conhecida ao fim do parse
+    cols["codigo_filial"] = [state["codigo_filial"]] * len(cols["filename"])
+
+    return cols
 
 
 def get_file_hash(uploaded_files):
     """Gera hash único baseado nos arquivos enviados"""
-    hasher = hashlib.md5()
+    hasher = hashlib.blake2b(digest_size=8)
     for file in uploaded_files:
         hasher.update(file.name.encode())
         hasher.update(str(file.size).encode())
     return hasher.hexdigest()
 
 
-def get_db_connection(session_id):
-    """Retorna conexão DuckDB persistente"""
+def get_file_fingerprint(uploaded_file):
+    """Gera impressão digital do arquivo (nome, tamanho e primeiros 4 KB)"""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(uploaded_file.name.encode())
+    hasher.update(str(uploaded_file.size).encode())
+    hasher.update(uploaded_file.getvalue()[:4096])
+    return hasher.hexdigest()
+
+
+@st.cache_resource(max_entries=DB_CACHE_MAX_ENTRIES, ttl=DB_CACHE_TTL)
+def get_database(session_id):
+    """Abre o banco DuckDB da sessão uma vez, compartilhado entre reexecuções.
+
+    Ao sair do cache o banco não é fechado explicitamente: fechar a conexão
+    principal invalida os cursores de execuções em andamento, e o DuckDB
+    libera a instância quando o último cursor é descartado.
+    """
     db_path = DB_DIR / f"session_{session_id}.duckdb"
     return duckdb.connect(str(db_path))
 
 
+def get_db_connection(session_id):
+    """Retorna conexão DuckDB própria da execução (cursor sobre o banco em cache)"""
+    return get_database(session_id).cursor()
+
+
 def process_xml_files(uploaded_files, session_id):
     """Processa arquivos XML enviados e retorna conexão DuckDB com dados"""
     # Conecta ao DuckDB em arquivo
     con = get_db_connection(session_id)
 
-    # Verifica se a tabela já existe e tem dados
+    # Importação já concluída nesta sessão: reutiliza os dados lendo só o _meta
     try:
-        existing_count = con.execute("SELECT COUNT(*) FROM itens_completos").fetchone()[
-            0
-        ]
+        meta = dict(
+            con.execute(
+                "SELECT key, value FROM _meta WHERE key IN ('complete', 'rows')"
+            ).fetchall()
+        )
+    except duckdb.CatalogException:
+        # Banco novo, tabelas ainda não existem
+        meta = {}
+
+    if "complete" in meta:
+        existing_count = int(meta.get("rows", 0))
         if existing_count > 0:
             st.info(
                 f"ℹ️ Dados já processados encontrados ({existing_count} registros). Usando dados existentes."
             )
-            return con, existing_count
-    except:
-        # Tabela não existe ainda
-        pass
-
-    # Namespace para XML de notas fiscais
-    ns = {"ns": "http://www.portalfiscal.inf.br/nfcom"}
-
-    dados_completos = []
-    total_files = len(uploaded_files)
+        return con, existing_count
 
     # Cria tabela no DuckDB
     con.execute(
@@ -99,195 +343,125 @@ def process_xml_files(uploaded_files, session_id):
         """
     )
 
-    # Barra de progresso
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-
-    # Processa cada arquivo enviado
-    for file_idx, uploaded_file in enumerate(uploaded_files):
-        file_name = uploaded_file.name
-        status_text.text(
-            f"Processando arquivo {file_idx + 1}/{total_files}: {file_name}"
-        )
-
-        # Salva arquivo temporariamente
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".xml") as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_file_path = tmp_file.name
-
-        try:
-            # Parse do XML
-            tree = etree.parse(tmp_file_path)
-
-            # Processa em lotes para melhor performance
-            batch_data = []
-
-            # Procura por cada nota fiscal
-            for fatura in tree.findall("Fatura", namespaces=ns):
-                # Extrai dados fiscais da nota (ide)
-                nf_com_vivo = fatura.find("NFComVivo", namespaces=ns)
-                ide = nf_com_vivo.find(".//ns:ide", namespaces=ns)
-                if ide is None:
-                    continue
-
-                nNF_elem = ide.find("ns:nNF", namespaces=ns)
-                dhEmi_elem = ide.find("ns:dhEmi", namespaces=ns)
-                codigo_filial = tree.findtext(".//sirius/codigo_filial", namespaces=ns)
-
-                if nNF_elem is None or dhEmi_elem is None:
-                    continue
-
-                try:
-                    nNF = int(nNF_elem.text)
-                    dhEmi = dhEmi_elem.text
-                except Exception:
-                    continue
-
-                total_info = fatura.find(".//ns:total", namespaces=ns)
-                vNF = (
-                    total_info.findtext("ns:vNF", namespaces=ns)
-                    if total_info is not None
-                    else None
-                )
-
-                # Para cada item <det> dentro dessa nota
-                for det in fatura.findall(".//ns:det", namespaces=ns):
-                    nItem = det.get("nItem")
-                    prod = det.find("ns:prod", namespaces=ns)
-                    if prod is None:
-                        continue
-
-                    cfop = prod.findtext("ns:CFOP", namespaces=ns, default="0000")
-                    cClass_text = prod.findtext("ns:cClass", namespaces=ns)
-                    cClass = cClass_text[:3] if cClass_text else None
-
-                    vProd = prod.findtext("ns:vProd", namespaces=ns)
-                    vBC = prod.findtext("ns:vBC", namespaces=ns)
-                    vDesc = prod.findtext("ns:vDesc", namespaces=ns)
-                    vOutro = prod.findtext("ns:vOutro", namespaces=ns)
+    # Tabela de controle da sessão (ex.: se os índices já foram criados)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS _meta (key VARCHAR PRIMARY KEY, value VARCHAR)"
+    )
 
-                    tag_imposto = det.find("ns:imposto", namespaces=ns)
-                    if tag_imposto is None:
-                        continue
+    # Impressões digitais dos arquivos já importados nesta sessão
+    con.execute("CREATE TABLE IF NOT EXISTS parsed_files (h VARCHAR PRIMARY KEY)")
+
+    # Retomada de importação interrompida: ignora arquivos já processados
+    parsed = {h for (h,) in con.execute("SELECT h FROM parsed_files").fetchall()}
+    pending_files = []
+    copies = {}
+    for uploaded_file in uploaded_files:
+        h = get_file_fingerprint(uploaded_file)
+        # Cópias idênticas no mesmo envio recebem chaves distintas, para que
+        # nenhuma seja descartada
+        n = copies.get(h, 0)
+        copies[h] = n + 1
+        if n:
+            h = f"{h}-{n}"
+        if h not in parsed:
+            pending_files.append((h, uploaded_file))
+
+    # Registros já gravados por uma importação interrompida (total salvo em
+    # _meta a cada lote)
+    if "rows" in meta:
+        existing_count = int(meta["rows"])
+    else:
+        existing_count = con.execute("SELECT COUNT(*) FROM itens_completos").fetchone()[
+            0
+        ]
 
-                    indicador_devolucao = tag_imposto.findtext(
-                        "ns:indDevolucao", namespaces=ns, default="0"
-                    )
-                    ind_sem_cst = tag_imposto.findtext(
-                        "ns:indSemCST", namespaces=ns, default="-"
-                    )
+    total_inserted = 0
+    # Lote em formato colunar: uma lista por coluna da tabela
+    cols = {name: [] for name in ITENS_SCHEMA.names}
+    # Arquivos cujos registros estão todos no lote atual
+    batch_fingerprints = []
+    total_files = len(pending_files)
 
-                    pis_cst = tag_imposto.find("ns:PIS/ns:CST", namespaces=ns)
-                    cofins_cst = tag_imposto.find("ns:COFINS/ns:CST", namespaces=ns)
-
-                    pis_vbc = tag_imposto.find("ns:PIS/ns:vBC", namespaces=ns)
-                    cofins_vbc = tag_imposto.find("ns:COFINS/ns:vBC", namespaces=ns)
-
-                    vicms = "0"
-                    ICMS_CODE = "-"
-                    for tag in icms_tags:
-                        caminho = f".//ns:{tag}/ns:vICMS"
-                        vICMS_element = tag_imposto.find(caminho, namespaces=ns)
-                        if vICMS_element is not None:
-                            vicms = vICMS_element.text
-                            ICMS_CODE = tag.split("ICMS")[1]
-                            break
-
-                    # Converte valores para float
-                    vProd = safe_float(vProd)
-                    vBC = safe_float(vBC)
-                    vDesc = safe_float(vDesc)
-                    vOutro = safe_float(vOutro)
-                    vNF = safe_float(vNF)
-                    pis_vbc = safe_float(pis_vbc.text if pis_vbc is not None else None)
-                    cofins_vbc = safe_float(
-                        cofins_vbc.text if cofins_vbc is not None else None
-                    )
-                    vicms = safe_float(vicms if vicms is not None else None)
-
-                    batch_data.append(
-                        (
-                            file_name,
-                            codigo_filial,
-                            nNF,
-                            dhEmi,
-                            nItem,
-                            cfop,
-                            cClass,
-                            vProd,
-                            vBC,
-                            vDesc,
-                            vOutro,
-                            vNF,
-                            pis_cst.text if pis_cst is not None else None,
-                            cofins_cst.text if cofins_cst is not None else None,
-                            pis_vbc,
-                            cofins_vbc,
-                            vicms,
-                            ICMS_CODE,
-                            indicador_devolucao,
-                            ind_sem_cst,
-                        )
-                    )
-
-                    # Insere em lotes de 1000 registros para melhor performance
-                    if len(batch_data) >= 1000:
-                        con.executemany(
-                            """
-                            INSERT INTO itens_completos (
-                                filename, codigo_filial, nNF, dhEmi, nItem,
-                                CFOP, cClass, vProd, vBC,
-                                vDesc, vOutro, vNF, pis_cst,
-                                cofins_cst, pis_vbc, cofins_vbc, vicms,
-                                ICMS_CODE, indicador_devolucao, ind_sem_cst
-                            )
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """,
-                            batch_data,
-                        )
-                        dados_completos.extend(batch_data)
-                        batch_data = []
-
-            # Insere dados restantes do lote
-            if batch_data:
-                con.executemany(
-                    """
-                    INSERT INTO itens_completos (
-                        filename, codigo_filial, nNF, dhEmi, nItem,
-                        CFOP, cClass, vProd, vBC,
-                        vDesc, vOutro, vNF, pis_cst,
-                        cofins_cst, pis_vbc, cofins_vbc, vicms,
-                        ICMS_CODE, indicador_devolucao, ind_sem_cst
+    # Barra de progresso
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    last_ui = 0.0
+
+    # Parse dos arquivos em paralelo; a inserção no DuckDB fica na thread principal
+    # e segue a ordem de envio dos arquivos. Só PARSE_AHEAD arquivos por thread
+    # ficam em andamento, limitando a memória dos resultados ainda não inseridos
+    max_workers = os.cpu_count() or 1
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    in_flight = deque()
+    next_idx = 0
+    try:
+        for file_idx, (h, uploaded_file) in enumerate(pending_files):
+            while next_idx < total_files and len(in_flight) < max_workers * PARSE_AHEAD:
+                _, next_file = pending_files[next_idx]
+                in_flight.append(
+                    executor.submit(
+                        parse_xml_file, next_file.getvalue(), next_file.name
                     )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    batch_data,
                 )
-                dados_completos.extend(batch_data)
-
-        finally:
-            # Remove arquivo temporário
-            os.unlink(tmp_file_path)
+                next_idx += 1
+
+            file_cols = in_flight.popleft().result()
+            file_name = uploaded_file.name
+            for name, values in cols.items():
+                values.extend(file_cols[name])
+            batch_fingerprints.append(h)
+
+            # Insere em lotes para melhor performance
+            if len(cols["filename"]) >= BATCH_SIZE:
+                total_inserted += len(cols["filename"])
+                insert_batch(
+                    con, cols, batch_fingerprints, existing_count + total_inserted
+                )
 
-        # Atualiza barra de progresso
-        progress_bar.progress((file_idx + 1) / total_files)
+            # Atualiza barra de progresso (limitada a ~20 atualizações por segundo)
+            now = time.monotonic()
+            if now - last_ui > PROGRESS_INTERVAL or file_idx + 1 == total_files:
+                last_ui = now
+                status_text.text(
+                    f"Processado arquivo {file_idx + 1}/{total_files}: {file_name}"
+                )
+                progress_bar.progress((file_idx + 1) / total_files)
+    except BaseException:
+        # Em caso de erro (ou parada do script), descarta os arquivos ainda não
+        # iniciados sem esperar pelos que estão em andamento
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    # Insere dados restantes do lote
+    if batch_fingerprints:
+        total_inserted += len(cols["filename"])
+        insert_batch(con, cols, batch_fingerprints, existing_count + total_inserted)
 
     # Limpa elementos de progresso
     progress_bar.empty()
     status_text.empty()
 
-    # Cria índices para melhor performance das consultas
-    try:
-        con.execute("CREATE INDEX IF NOT EXISTS idx_nNF ON itens_completos(nNF)")
-        con.execute("CREATE INDEX IF NOT EXISTS idx_dhEmi ON itens_completos(dhEmi)")
-        con.execute("CREATE INDEX IF NOT EXISTS idx_CFOP ON itens_completos(CFOP)")
-        con.execute(
-            "CREATE INDEX IF NOT EXISTS idx_filename ON itens_completos(filename)"
-        )
-    except:
-        pass  # Índices podem já existir
+    # Cria índices uma única vez, em bloco, após a carga inicial
+    indexed = con.execute("SELECT value FROM _meta WHERE key = 'indexed'").fetchone()
+    if indexed is None:
+        try:
+            con.execute("CREATE INDEX IF NOT EXISTS idx_nNF ON itens_completos(nNF)")
+            con.execute(
+                "CREATE INDEX IF NOT EXISTS idx_dhEmi ON itens_completos(dhEmi)"
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS idx_CFOP ON itens_completos(CFOP)")
+            con.execute(
+                "CREATE INDEX IF NOT EXISTS idx_filename ON itens_completos(filename)"
+            )
+            con.execute("INSERT INTO _meta VALUES ('indexed', 'true')")
+        except:
+            pass  # Índices podem já existir
+
+    # Marca a importação como concluída; próximas execuções retornam cedo
+    con.execute("INSERT OR REPLACE INTO _meta VALUES ('complete', 'true')")
 
-    return con, len(dados_completos)
+    return con, existing_count + total_inserted
 
 
 def main():
@@ -323,9 +497,12 @@ def main():
         if st.button("🗑️ Limpar Dados", help="Remove todos os dados processados"):
             if "session_id" in st.session_state:
                 try:
-                    db_path = (
-                        DB_DIR / f"session_{st.session_state['session_id']}.duckdb"
-                    )
+                    session_id = st.session_state["session_id"]
+                    # Tira o banco do cache; outras execuções mantêm seus cursores
+                    get_database.clear(session_id)
+                    st.session_state.pop("total_records", None)
+
+                    db_path = DB_DIR / f"session_{session_id}.duckdb"
                     if db_path.exists():
                         db_path.unlink()
                     st.success("✅ Dados limpos com sucesso!")
@@ -348,8 +525,7 @@ def main():
                         f"✅ Processamento concluído! {total_records} registros disponíveis."
                     )
 
-                    # Armazena conexão no session state
-                    st.session_state["db_connection"] = con
+                    # Banco fica em cache (get_database); guarda só o total
                     st.session_state["total_records"] = total_records
 
                     # Mostra informações básicas
@@ -374,12 +550,13 @@ def main():
 
                 else:
                     st.warning("⚠️ Nenhum registro foi encontrado nos arquivos XML.")
+                    st.session_state.pop("total_records", None)
 
             except Exception as e:
                 st.error(f"❌ Erro ao processar arquivos: {str(e)}")
 
     # Área de consultas SQL
-    if "db_connection" in st.session_state:
+    if "total_records" in st.session_state:
         st.markdown("---")
         st.header("🔍 Consultas SQL")
 
@@ -454,18 +631,26 @@ ORDER BY mes DESC;
                     if limit_results and "LIMIT" not in final_query.upper():
                         final_query += " LIMIT 1000"
 
-                    result = st.session_state["db_connection"].execute(final_query).df()
+                    con = get_db_connection(st.session_state["session_id"])
+                    # Resultado em Arrow, sem conversão para DataFrame pandas
+                    result = con.execute(final_query).fetch_arrow_table()
 
-                    if not result.empty:
+                    if result.num_rows > 0:
                         st.success(
-                            f"✅ Consulta executada! {len(result)} linha(s) retornada(s)."
+                            f"✅ Consulta executada! {result.num_rows} linha(s) retornada(s)."
                         )
 
                         # Mostra resultado em tabela
                         st.dataframe(result, use_container_width=True, hide_index=True)
 
                         # Opção para download
-                        csv = result.to_csv(index=False)
+                        try:
+                            csv_buffer = BytesIO()
+                            pa_csv.write_csv(result, csv_buffer)
+                            csv = csv_buffer.getvalue()
+                        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                            # Tipos sem suporte no CSV do Arrow (LIST, STRUCT, INTERVAL)
+                            csv = result.to_pandas().to_csv(index=False)
                         st.download_button(
                             label="📥 Baixar Resultado (CSV)",
                             data=csv,